@@ -1,12 +1,42 @@
 import os
-from flask import Flask, request, jsonify, session
+from flask import Flask, request, jsonify, Response, stream_with_context
+from flask.sessions import SessionInterface
 from dotenv import load_dotenv
 import google.generativeai as genai
+from google import genai as google_genai
 import firebase_admin
 from firebase_admin import credentials, auth, firestore
+from firebase_admin import _token_gen
 from flask_cors import CORS # Import CORS
 import datetime
-import traceback
+import logging
+import queue
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import json
+import hashlib
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from cachetools import TTLCache
+import redis
+
+_UTC = datetime.timezone.utc
+
+# --- Logging ---
+# Error logs go through a queue so request threads never block writing
+# tracebacks to stderr; a listener thread does the actual I/O.
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.SimpleQueue()
+logger.addHandler(QueueHandler(_log_queue))
+_log_handler = logging.StreamHandler()
+_log_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+_log_listener = QueueListener(_log_queue, _log_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 # Load environment variables
 load_dotenv()
@@ -31,53 +61,234 @@ genai.configure(api_key=GEMINI_API_KEY)
 # Make model configurable via .env (for example: GEMINI_MODEL=gemini-2.5-flash)
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
 print(f"Using GEMINI_MODEL={GEMINI_MODEL}")
+# Client for the Gemini Batch API (offline, latency-tolerant jobs at the batch discount)
+batch_client = google_genai.Client(api_key=GEMINI_API_KEY)
 
 # --- Flask App Initialization ---
 app = Flask(__name__)
-app.secret_key = os.getenv("FLASK_SECRET_KEY", "a_default_strong_secret_key")
+
+# Auth is via Firebase ID tokens, so Flask's cookie session is never used;
+# skip opening and signing it on every request.
+class NoSessionInterface(SessionInterface):
+    def open_session(self, app, request):
+        return self.make_null_session(app)
+
+    def save_session(self, app, session, response):
+        pass
+
+app.session_interface = NoSessionInterface()
 # Enable CORS for your React app's origin
 CORS(app, supports_credentials=True, origins=["http://localhost:3000"])
 
 
 # --- Socratic AI Prompts ---
 CREATOR_NOTE = "Creator: Syed Gohar Hussain."
-SYSTEM_PROMPTS = {
+MODE_PROMPTS = {
     "coding_coach": (
-        CREATOR_NOTE + " " + (
-            "You are CodeSensei, a 'Coding Coach'. Your goal is to help users learn by guiding them, "
-            "not giving direct answers. Use the Socratic method. Ask probing questions that lead them "
-            "to the solution. Provide small hints and conceptual explanations. Never write whole blocks of code. "
-            "Your tone is encouraging, wise, and patient, like a sensei."
-        )
+        "You are CodeSensei, a 'Coding Coach'. Your goal is to help users learn by guiding them, "
+        "not giving direct answers. Use the Socratic method. Ask probing questions that lead them "
+        "to the solution. Provide small hints and conceptual explanations. Never write whole blocks of code. "
+        "Your tone is encouraging, wise, and patient, like a sensei."
     ),
     "debugging_assistant": (
-        CREATOR_NOTE + " " + (
-            "You are CodeSensei, a 'Debugging Assistant'. The user will provide code with errors. "
-            "Analyze it carefully. Do not fix the code for them. Instead, identify the errors and give hints "
-            "about where to look and what concepts might be involved. For example, say 'Look closely at your loop on line 5. "
-            "What happens on the final iteration?' or 'That error often relates to variable types. Have you checked the type of 'x'?'"
-        )
+        "You are CodeSensei, a 'Debugging Assistant'. The user will provide code with errors. "
+        "Analyze it carefully. Do not fix the code for them. Instead, identify the errors and give hints "
+        "about where to look and what concepts might be involved. For example, say 'Look closely at your loop on line 5. "
+        "What happens on the final iteration?' or 'That error often relates to variable types. Have you checked the type of 'x'?'"
     ),
     "general": (
-        CREATOR_NOTE + " " + (
-            "You are CodeSensei, a helpful AI assistant with a Socratic teaching style. For any general question, "
-            "your role is to foster understanding and critical thinking. Break down complex topics into smaller, "
-            "manageable parts. Ask questions to gauge the user's understanding before providing more information. "
-            "Guide them towards discovering the answer themselves."
-        )
+        "You are CodeSensei, a helpful AI assistant with a Socratic teaching style. For any general question, "
+        "your role is to foster understanding and critical thinking. Break down complex topics into smaller, "
+        "manageable parts. Ask questions to gauge the user's understanding before providing more information. "
+        "Guide them towards discovering the answer themselves."
     )
 }
+SYSTEM_PROMPTS = {mode: CREATOR_NOTE + " " + prompt for mode, prompt in MODE_PROMPTS.items()}
+
+# One model per mode, built once and reused; the prompt goes in system_instruction
+MODELS = {
+    mode: genai.GenerativeModel(GEMINI_MODEL, system_instruction=prompt)
+    for mode, prompt in SYSTEM_PROMPTS.items()
+}
+
+# --- Firestore path helpers ---
+USERS = db.collection('users')
+
+def _sessions(uid):
+    return USERS.document(uid).collection('sessions')
+
+def _messages(uid, sid):
+    return _sessions(uid).document(sid).collection('messages')
+
+def _batch_jobs(uid):
+    return USERS.document(uid).collection('batch_jobs')
+
+# --- Verified token cache ---
+# Verified ID tokens are cached by hash for at most 5 minutes; a cached entry is
+# never served past the token's own 'exp', so expiry is still respected.
+TOKEN_CACHE_TTL = 300
+_tok_cache = TTLCache(maxsize=10000, ttl=TOKEN_CACHE_TTL)
+_tok_lock = threading.Lock()
+
+# Optional shared second tier (REDIS_URL) so all workers reuse each other's
+# verifications; it stores only the decoded claims, keyed by the token hash.
+REDIS_URL = os.getenv("REDIS_URL")
+# Short socket timeouts so an unresponsive Redis counts as a cache miss instead
+# of stalling every authenticated request.
+REDIS_TIMEOUT_SECONDS = 0.1
+token_redis = redis.Redis.from_url(
+    REDIS_URL,
+    socket_connect_timeout=REDIS_TIMEOUT_SECONDS,
+    socket_timeout=REDIS_TIMEOUT_SECONDS
+) if REDIS_URL else None
+
+def _shared_token_get(token_key):
+    if token_redis is None:
+        return None
+    try:
+        cached = token_redis.get(f"jwtcache:{token_key}")
+        return json.loads(cached) if cached else None
+    except Exception as e:
+        logger.warning("Shared token cache read failed: %s", e)
+        return None
+
+def _shared_token_set(token_key, decoded_token, ttl):
+    if token_redis is None:
+        return
+    try:
+        token_redis.setex(f"jwtcache:{token_key}", ttl, json.dumps(decoded_token))
+    except Exception as e:
+        logger.warning("Shared token cache write failed: %s", e)
+
+# Pre-fetch Google's ID token signing certificates into the verifier's cached
+# HTTP session so the first user request doesn't pay the cold fetch.
+def warm_token_verifier():
+    try:
+        verifier = auth._get_client(firebase_admin.get_app())._token_verifier
+        verifier.request(_token_gen.ID_TOKEN_CERT_URI)
+    except Exception as e:
+        logger.warning("Token verifier warm-up failed: %s", e)
+
+warm_token_verifier()
 
 # --- Helper function to verify Firebase ID token ---
 def verify_token(request):
     try:
         id_token = request.headers.get('Authorization').split('Bearer ')[1]
+        token_key = hashlib.sha256(id_token.encode()).hexdigest()[:32]
+        with _tok_lock:
+            decoded_token = _tok_cache.get(token_key)
+        if decoded_token and decoded_token['exp'] > time.time():
+            return decoded_token
+
+        decoded_token = _shared_token_get(token_key)
+        if decoded_token and decoded_token['exp'] > time.time():
+            with _tok_lock:
+                _tok_cache[token_key] = decoded_token
+            return decoded_token
+
         decoded_token = auth.verify_id_token(id_token)
+        ttl = int(decoded_token['exp'] - time.time())
+        if ttl > 0:
+            with _tok_lock:
+                _tok_cache[token_key] = decoded_token
+            _shared_token_set(token_key, decoded_token, ttl)
         return decoded_token
     except Exception as e:
         print(f"Token verification failed: {e}")
         return None
 
+# --- Conversation history cache ---
+# Keeps the last HISTORY_LIMIT turns of each (user_id, session_id) in memory.
+# Each gunicorn worker has its own cache, so a warm turn still makes one
+# Firestore round-trip: a limit(1) read of the newest stored message, reloading
+# the entry if another worker has written since. What the cache saves is the
+# size of that read (one document billed and transferred instead of up to
+# HISTORY_LIMIT), not the round-trip. Cold turns make a single HISTORY_LIMIT
+# read. Entries are only touched under _history_lock, and callers get a list
+# snapshot rather than the shared deque.
+HISTORY_LIMIT = 20
+_history_cache = TTLCache(maxsize=2000, ttl=600)
+_history_lock = threading.Lock()
+
+def _history_entry(msg):
+    # Every stored message has both fields (see store_messages)
+    return {"role": "model" if msg['role'] == 'assistant' else 'user', "parts": [msg['content']]}
+
+def _newest_timestamp(messages_collection):
+    newest = list(messages_collection.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(1).stream())
+    return newest[0].get('timestamp') if newest else None
+
+def _is_current(cached, newest):
+    if newest is None:
+        # An empty collection only matches an empty entry; cached turns for a
+        # session with no stored messages mean it was deleted (possibly by
+        # another worker) and must not be replayed
+        return not cached['turns']
+    # Nothing stored after what this worker already knows about
+    return newest <= cached['last']
+
+def extend_history(user_id, session_id, messages_collection, turn, timestamp):
+    """Appends a turn to the session's history, (re)loading it from Firestore when stale, and returns a snapshot."""
+    key = (user_id, session_id)
+    with _history_lock:
+        is_cached = key in _history_cache
+    if is_cached:
+        # Only probe Firestore when there is an entry to validate
+        newest = _newest_timestamp(messages_collection)
+        with _history_lock:
+            cached = _history_cache.get(key)
+            if cached is not None and _is_current(cached, newest):
+                cached['turns'].append(turn)
+                cached['last'] = max(cached['last'], timestamp)
+                return list(cached['turns'])
+
+    # Newest HISTORY_LIMIT messages, replayed oldest-first
+    history_docs = list(messages_collection.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(HISTORY_LIMIT).stream())
+    turns = deque((_history_entry(doc.to_dict()) for doc in reversed(history_docs)), maxlen=HISTORY_LIMIT)
+    turns.append(turn)
+    with _history_lock:
+        _history_cache[key] = {'turns': turns, 'last': timestamp}
+        return list(turns)
+
+def record_turn(user_id, session_id, turn, timestamp):
+    """Appends a turn to the cached history if the session is still cached."""
+    with _history_lock:
+        cached = _history_cache.get((user_id, session_id))
+        if cached is not None:
+            cached['turns'].append(turn)
+            cached['last'] = max(cached['last'], timestamp)
+
+def drop_history(user_id, session_id):
+    with _history_lock:
+        _history_cache.pop((user_id, session_id), None)
+
+# --- Background Firestore writes ---
+# Message writes are dispatched off the request thread so responses don't
+# wait on Firestore round-trips.
+EXECUTOR = ThreadPoolExecutor(max_workers=8)
+
+def _report_write_failure(future):
+    exc = future.exception()
+    if exc is not None:
+        logger.error("background write failed", exc_info=exc)
+
+def submit_write(fn, *args, **kwargs):
+    future = EXECUTOR.submit(fn, *args, **kwargs)
+    future.add_done_callback(_report_write_failure)
+    return future
+
+def store_messages(messages_collection, *messages):
+    """Commits (role, content, timestamp) messages as a single batch in the background."""
+    batch = db.batch()
+    for role, content, timestamp in messages:
+        batch.set(messages_collection.document(), {
+            'role': role,
+            'content': content,
+            'timestamp': timestamp
+        })
+    return submit_write(batch.commit)
+
 # --- API Routes ---
 
 @app.route("/api/get_chat_sessions")
@@ -88,8 +299,9 @@ def get_chat_sessions():
         return jsonify({"error": "Unauthorized"}), 401
     try:
         user_id = user['uid']
-        sessions_ref = db.collection('users').document(user_id).collection('sessions').order_by('created_at', direction=firestore.Query.DESCENDING)
-        sessions = [{"id": doc.id, "name": doc.to_dict().get("name", f"Session {doc.id[:5]}")} for doc in sessions_ref.stream()]
+        # Only the name is needed, so project it server-side; create_session always stores it
+        sessions_ref = _sessions(user_id).select(['name']).order_by('created_at', direction=firestore.Query.DESCENDING)
+        sessions = [{"id": doc.id, "name": doc.get("name")} for doc in sessions_ref.stream()]
         return jsonify(sessions)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -100,23 +312,23 @@ def create_session():
     if not user: return jsonify({"error": "Unauthorized"}), 401
     try:
         user_id = user['uid']
-        timestamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y-%m-%d %H:%M")
         body = request.json or {}
         session_name = body.get('session_name')
         if session_name:
             # Use provided session_name as document ID (sanitized)
             doc_id = session_name
-            new_session_ref = db.collection('users').document(user_id).collection('sessions').document(doc_id)
+            new_session_ref = _sessions(user_id).document(doc_id)
         else:
-            new_session_ref = db.collection('users').document(user_id).collection('sessions').document()
+            session_name = f"Chat - {datetime.datetime.now(_UTC):%Y-%m-%d %H:%M}"
+            new_session_ref = _sessions(user_id).document()
 
         new_session_ref.set({
-            "name": session_name or f"Chat - {timestamp}",
+            "name": session_name,
             "created_at": firestore.SERVER_TIMESTAMP
         })
-        return jsonify({"session_id": new_session_ref.id, "name": session_name or f"Chat - {timestamp}"})
+        return jsonify({"session_id": new_session_ref.id, "name": session_name})
     except Exception as e:
-        traceback.print_exc()
+        logger.exception("create_session failed")
         return jsonify({"error": str(e)}), 500
 
 
@@ -127,23 +339,44 @@ def get_session_messages(session_id):
     if not user: return jsonify({"error": "Unauthorized"}), 401
     try:
         user_id = user['uid']
-        messages_ref = db.collection('users').document(user_id).collection('sessions').document(session_id).collection('messages').order_by('timestamp')
+        messages_ref = _messages(user_id, session_id).order_by('timestamp')
         messages = [msg.to_dict() for msg in messages_ref.stream()]
         return jsonify(messages)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+MESSAGE_DELETE_MAX_ATTEMPTS = 15
+
 @app.route("/api/delete_session/<session_id>", methods=["DELETE"])
 def delete_session(session_id):
-    """Deletes a chat session."""
+    """Deletes a chat session and its messages."""
     user = verify_token(request)
     if not user: return jsonify({"error": "Unauthorized"}), 401
     try:
         user_id = user['uid']
-        # Note: Deleting a document does not delete its subcollections.
-        # For a production app, use a Cloud Function to handle recursive deletes.
-        db.collection('users').document(user_id).collection('sessions').document(session_id).delete()
+        drop_history(user_id, session_id)
+        # Deleting a document does not delete its subcollections, so clear the
+        # messages first; BulkWriter pipelines the deletes with backoff.
+        bulk_writer = db.bulk_writer()
+        failed_deletes = []
+
+        def on_delete_error(error, _bulk_writer):
+            # Retry like the default handler, but remember deletes that were given up on
+            if error.attempts < MESSAGE_DELETE_MAX_ATTEMPTS:
+                return True
+            failed_deletes.append(error)
+            return False
+
+        bulk_writer.on_write_error(on_delete_error)
+        for message_ref in _messages(user_id, session_id).list_documents():
+            bulk_writer.delete(message_ref)
+        bulk_writer.close()
+        if failed_deletes:
+            # Keep the session so its remaining messages aren't orphaned
+            logger.error("delete_session: %d message deletes failed for session %s", len(failed_deletes), session_id)
+            return jsonify({"error": f"Failed to delete {len(failed_deletes)} message(s); session was not deleted."}), 500
+        _sessions(user_id).document(session_id).delete()
         return jsonify({"success": True})
     except Exception as e:
         return jsonify({"error": str(e)}), 500
@@ -163,54 +396,126 @@ def chat():
     if not user_message or not session_id:
         return jsonify({"error": "Message and session_id are required"}), 400
 
+    messages_collection = _messages(user_id, session_id)
+    # Both messages are committed together once the reply is complete; client-side
+    # timestamps keep them ordered (a batch gives every SERVER_TIMESTAMP the same value).
+    user_message_entry = ('user', user_message, datetime.datetime.now(_UTC))
+
     try:
-        messages_collection = db.collection('users').document(user_id).collection('sessions').document(session_id).collection('messages')
-        
-        # Store user message
-        messages_collection.add({
-            'role': 'user',
-            'content': user_message,
-            'timestamp': firestore.SERVER_TIMESTAMP
-        })
+        # Fetch conversation history (warm turns only re-check the newest message)
+        history = extend_history(user_id, session_id, messages_collection,
+                                 {"role": "user", "parts": [user_message]}, user_message_entry[2])
 
-        # Fetch conversation history
-        history_docs = messages_collection.order_by('timestamp', direction=firestore.Query.DESCENDING).limit(20).stream()
-        history = []
-        for doc in history_docs:
-            msg = doc.to_dict()
-            role = "model" if msg.get('role') == 'assistant' else 'user'
-            history.insert(0, {"role": role, "parts": [msg.get('content')]})
+        # Generate AI Response
+        model = MODELS.get(mode, MODELS["general"])
+        response = model.generate_content(history, stream=True)
 
+    except Exception as e:
+        logger.exception("chat failed")
+        store_messages(messages_collection, user_message_entry)
+        return jsonify({"error": "An error occurred.", "details": str(e)}), 500
 
-        # Generate AI Response
-        model = genai.GenerativeModel(GEMINI_MODEL)
-        system_instruction = SYSTEM_PROMPTS.get(mode, SYSTEM_PROMPTS["general"])
+    def generate():
+        """Relays the response to the client as server-sent events while it is produced."""
+        chunks = []
+        try:
+            for chunk in response:
+                # A chunk may carry only a finish_reason; it has no text to relay
+                if chunk.candidates and not chunk.parts:
+                    continue
+                text = chunk.text
+                chunks.append(text)
+                yield f"data: {json.dumps({'response': text})}\n\n"
+            yield "data: [DONE]\n\n"
+        except ValueError as e:
+            # chunk.text raises ValueError when a reply was blocked or has no usable
+            # candidate; the status line is already sent, so report it as a 502 event
+            logger.exception("chat failed: unexpected response from Gemini")
+            yield f"event: error\ndata: {json.dumps({'error': 'Bad response from the AI service.', 'status': 502, 'details': str(e)})}\n\n"
+        except Exception as e:
+            logger.exception("chat failed while streaming")
+            yield f"event: error\ndata: {json.dumps({'error': 'An error occurred.', 'details': str(e)})}\n\n"
+        finally:
+            ai_message = "".join(chunks)
+            if ai_message:
+                # Store user and AI messages in one batch
+                ai_timestamp = datetime.datetime.now(_UTC)
+                store_messages(messages_collection, user_message_entry,
+                               ('assistant', ai_message, ai_timestamp))
+                record_turn(user_id, session_id, {"role": "model", "parts": [ai_message]}, ai_timestamp)
+            else:
+                store_messages(messages_collection, user_message_entry)
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream')
 
-        conversation = [
-            {"role": "user", "parts": [system_instruction]},
-            {"role": "model", "parts": ["Understood. I will act as CodeSensei and guide the user."]}
-        ] + history
-
-        response = model.generate_content(conversation)
-        # The Python client may return different shapes; try to recover text safely
-        ai_message = getattr(response, 'text', None) or response
-        if isinstance(ai_message, dict) and 'candidates' in ai_message:
-            ai_message = ai_message['candidates'][0].get('content', '')
-
-        # Store AI message
-        messages_collection.add({
-            'role': 'assistant',
-            'content': ai_message,
-            'timestamp': firestore.SERVER_TIMESTAMP
+
+@app.route("/api/chat_batch", methods=["POST"])
+def chat_batch():
+    """Submits a list of messages to the Gemini Batch API for offline processing."""
+    user = verify_token(request)
+    if not user: return jsonify({"error": "Unauthorized"}), 401
+
+    data = request.json or {}
+    messages = data.get("messages")
+    mode = data.get("mode", "general")
+    user_id = user['uid']
+
+    if not messages or not isinstance(messages, list):
+        return jsonify({"error": "A non-empty list of messages is required"}), 400
+    if not all(isinstance(message, str) and message for message in messages):
+        return jsonify({"error": "Every message must be a non-empty string"}), 400
+
+    try:
+        system_instruction = SYSTEM_PROMPTS.get(mode, SYSTEM_PROMPTS["general"])
+        inlined_requests = [{
+            "contents": [{"role": "user", "parts": [{"text": message}]}],
+            "config": {"system_instruction": system_instruction}
+        } for message in messages]
+        batch_job = batch_client.batches.create(
+            model=GEMINI_MODEL,
+            src=inlined_requests,
+            config={"display_name": f"codesensei-{user_id}-{mode}"}
+        )
+        # Remember who owns the job so only they can poll it
+        _batch_jobs(user_id).document(batch_job.name.split('/')[-1]).set({
+            "name": batch_job.name,
+            "mode": mode,
+            "created_at": firestore.SERVER_TIMESTAMP
         })
+        return jsonify({"job": batch_job.name})
+    except Exception as e:
+        logger.exception("chat_batch failed")
+        return jsonify({"error": str(e)}), 500
 
-        return jsonify({"response": ai_message})
 
+@app.route("/api/batch_status/<path:job>")
+def batch_status(job):
+    """Reports the state of a batch job and, once it has succeeded, its responses."""
+    user = verify_token(request)
+    if not user: return jsonify({"error": "Unauthorized"}), 401
+    try:
+        # Accept either the full job name or its bare ID, and query Gemini with
+        # the name recorded at submission rather than the client-supplied path
+        job_id = job.split('/')[-1]
+        if job_id in ('', '.', '..'):
+            return jsonify({"error": "Batch job not found"}), 404
+        job_doc = _batch_jobs(user['uid']).document(job_id).get()
+        if not job_doc.exists or job not in (job_id, job_doc.get('name')):
+            return jsonify({"error": "Batch job not found"}), 404
+
+        batch_job = batch_client.batches.get(name=job_doc.get('name'))
+        result = {"job": batch_job.name, "state": batch_job.state.name}
+        if batch_job.state.name == "JOB_STATE_SUCCEEDED":
+            result["responses"] = [
+                {"response": r.response.text} if r.response else {"error": str(r.error)}
+                for r in batch_job.dest.inlined_responses
+            ]
+        return jsonify(result)
     except Exception as e:
-        traceback.print_exc()
-        print(f"Error during chat: {e}")
-        return jsonify({"error": "An error occurred.", "details": str(e)}), 500
+        return jsonify({"error": str(e)}), 500
 
 
+# Local development only; in production serve through gunicorn with threaded
+# workers (see Procfile) so slow Gemini calls don't block other requests.
 if __name__ == "__main__":
-    app.run(debug=True, port=5001) # Running on a different port than React
+    app.run(debug=os.getenv("FLASK_DEBUG") == "1", port=5001, threaded=True) # Running on a different port than React
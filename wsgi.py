@@ -1,5 +1,5 @@
 # wsgi.py
-from .app import app  # Import your Flask app instance
+from app import app  # Import your Flask app instance
 
 if __name__ == "__main__":
     app.run()
\ No newline at end of file